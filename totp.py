@@ -7,8 +7,117 @@
         algorithms
 """
 
-import time, hmac
-from base64 import b32decode
+import time, hmac, hashlib, struct, binascii
+
+# OpenSSL-backed constructors, looked up directly instead of by name
+_HASHES = {
+    'sha1'  : hashlib.sha1,
+    'sha256': hashlib.sha256,
+    'sha512': hashlib.sha512,
+}
+
+_U32 = struct.Struct('>I').unpack_from
+_U64 = struct.Struct('>Q').pack
+_NS_PER_S = 1_000_000_000
+
+_TRANS_36 = bytes(x ^ 0x36 for x in range(256))
+_TRANS_5C = bytes(x ^ 0x5c for x in range(256))
+
+_B32_ALPHABET = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+_B32_TO_INT32 = bytes.maketrans(_B32_ALPHABET, b'0123456789abcdefghijklmnopqrstuv')
+
+def _b32decode_fast(s):
+    """Same as base64.b32decode(s), but decodes the whole string at once:
+       the Base32 digits are mapped onto the ones int() takes for base 32
+    """
+    if isinstance(s, str):
+        s = s.encode('ascii')
+    s = bytes(s)
+    if len(s) % 8:
+        raise binascii.Error('Incorrect padding')
+    data = s.rstrip(b'=')
+    if data.translate(None, _B32_ALPHABET):
+        raise binascii.Error('Non-base32 digit found')
+    if len(s) - len(data) not in (0, 1, 3, 4, 6):
+        raise binascii.Error('Incorrect padding')
+    if not data:
+        return b''
+    n_bits = len(data) * 5
+    n_bytes = n_bits // 8
+    integer = int(data.translate(_B32_TO_INT32), 32)
+    return (integer >> (n_bits - n_bytes * 8)).to_bytes(n_bytes, 'big')
+
+# caches below hold secrets, so each keeps at most
+# _CACHE_SIZE entries and drops the oldest one when full
+_CACHE_SIZE = 128
+
+def _cache_put(cache, key, value):
+    # may run in several threads at once: the oldest key can be taken
+    # by another thread, or the dict can change while it is looked up,
+    # so eviction tolerates both and retries until under the limit
+    while len(cache) >= _CACHE_SIZE:
+        try:
+            cache.pop(next(iter(cache), None), None)
+        except RuntimeError:
+            pass
+    cache[key] = value
+
+# decoded keys, keyed by the Base32 bytes
+_B32_CACHE = {}
+
+def _b32decode_cached(s):
+    K = _B32_CACHE.get(s)
+    if K is None:
+        K = _b32decode_fast(s)
+        _cache_put(_B32_CACHE, s, K)
+    return K
+
+# inner and outer hash objects already fed with the padded key,
+# keyed by (K, algo); copying them skips the HMAC key setup
+_PAD_CACHE = {}
+
+def _hmac_pads(K, algo):
+    if type(K) is not bytes:
+        K = memoryview(K).tobytes()
+    pads = _PAD_CACHE.get((K, algo))
+    if pads is None:
+        H = _HASHES[algo]
+        block_size = H().block_size
+        k = H(K).digest() if len(K) > block_size else K
+        k = k.ljust(block_size, b'\0')
+        pads = H(k.translate(_TRANS_36)), H(k.translate(_TRANS_5C))
+        _cache_put(_PAD_CACHE, (K, algo), pads)
+    return pads
+
+def _make_hotp(algo, n_digits):
+    # HOTP with the modulus and the output format fixed in advance
+    modulus = 10**n_digits
+    fmt = f'{{:0{n_digits}d}}'.format
+    
+    def hotp_(K, C):
+        inner, outer = _hmac_pads(K, algo)
+        inner = inner.copy()
+        inner.update(C)
+        outer = outer.copy()
+        outer.update(inner.digest())
+        hash = outer.digest()
+        offset = hash[-1] & 0x0f
+        return fmt((_U32(hash, offset)[0] & 0x7fffffff) % modulus)
+    
+    return hotp_
+
+# the values documented below: n_digits is one of 6,7 or 8,
+# algo is one of sha1, sha256 or sha512
+_HOTP = {(a, n): _make_hotp(a, n) for a in _HASHES for n in (6, 7, 8)}
+
+def _get_hotp(algo, n_digits):
+    try:
+        return _HOTP[algo, n_digits]
+    except (KeyError, TypeError):
+        raise ValueError(
+            f"unsupported algo {algo!r} or n_digits {n_digits!r}: "
+            "n_digits is one of 6,7 or 8, "
+            "algo is one of sha1, sha256 or sha512") from None
 
 def hotp(K, C, n_digits=6, algo='sha1'):
     """HOTP: An HMAC-Based One-Time Password Algorithm [RFC 4226]
@@ -17,14 +126,17 @@ def hotp(K, C, n_digits=6, algo='sha1'):
        n_digits - is one of 6,7 or 8
        algo     - is one of sha1, sha256 or sha512
     """
-    hash = hmac.new(K, C, algo).digest()
-    offset = hash[-1] & 0x0f
-    truncated = hash[offset:offset+4]
-    integer = int.from_bytes(truncated, 'big')
-    integer &= 0x7fffffff
-    otp = integer % 10**n_digits
-    result = str(otp).zfill(n_digits)
-    return result
+    return _get_hotp(algo, n_digits)(K, C)
+
+def hotp_batch(keys, C, n_digits=6, algo='sha1'):
+    """Returns a list of HOTPs for many keys and the same counter
+       keys     - list of shared secret bytes
+       C        - 8 byte counter value
+       n_digits - is one of 6,7 or 8
+       algo     - is one of sha1, sha256 or sha512
+    """
+    hotp_ = _get_hotp(algo, n_digits)
+    return [hotp_(K, C) for K in keys]
 
 def totp(K, period=30, n_digits=6, algo='sha1'):
     """TOTP: Time-Based One-Time Password Algorithm [RFC 6238]
@@ -33,8 +145,8 @@ def totp(K, period=30, n_digits=6, algo='sha1'):
        n_digits - is one of 6,7 or 8
        algo     - is one of sha1, sha256 or sha512
     """
-    time_step = int(time.time()) // period
-    C = time_step.to_bytes(8, 'big')
+    time_step = time.time_ns() // (period * _NS_PER_S)
+    C = _U64(time_step)
     return hotp(K, C, n_digits, algo)
 
 def totp_from_base32_key(b32key, period=30, n_digits=6, algo='sha1'):
@@ -44,11 +156,79 @@ def totp_from_base32_key(b32key, period=30, n_digits=6, algo='sha1'):
        n_digits - is one of 6,7 or 8
        algo     - is one of sha1, sha256 or sha512
     """
-    K = b32decode(b32key)
+    if isinstance(b32key, str):
+        b32key = b32key.encode('ascii')
+    K = _b32decode_cached(bytes(b32key))
     return totp(K, period, n_digits, algo)
 
+def totp_window(K, now=None, period=30, k=1, n_digits=6, algo='sha1'):
+    """Returns a list of 2k+1 TOTPs for time steps from -k to +k
+       around the current one, e.g. to tolerate clock skew
+       K        - shared secret bytes
+       now      - Unix time in seconds, current time if None
+       period   - time step size, in seconds
+       k        - number of time steps on each side
+       n_digits - is one of 6,7 or 8
+       algo     - is one of sha1, sha256 or sha512
+    """
+    if now is None:
+        time_step = time.time_ns() // (period * _NS_PER_S)
+    else:
+        time_step = int(now) // period
+    if time_step < k:
+        raise ValueError(f"time step {time_step} is less than k={k}, "
+                          "the window would start before the Unix epoch")
+    return [hotp(K, _U64(time_step + i), n_digits, algo)
+            for i in range(-k, k+1)]
+
+def verify_totp(K, code, now=None, period=30, k=1, n_digits=6, algo='sha1'):
+    """Checks a TOTP against the 2k+1 time steps around the current one,
+       all candidates are compared in constant time;
+       returns True if any of them matches
+       K        - shared secret bytes
+       code     - bytes or string of the TOTP to check
+       now      - Unix time in seconds, current time if None
+       period   - time step size, in seconds
+       k        - number of time steps on each side
+       n_digits - is one of 6,7 or 8
+       algo     - is one of sha1, sha256 or sha512
+    """
+    if isinstance(code, str):
+        code = code.encode()
+    expected = totp_window(K, now, period, k, n_digits, algo)
+    match = False
+    for e in expected:
+        match |= hmac.compare_digest(code, e.encode())
+    return match
+
+def totp_many(items):
+    """Returns a list of TOTPs computed for the same moment of time
+       items    - list of (K, period, n_digits, algo) tuples,
+                  see totp() for the meaning of each field
+    """
+    now = time.time_ns()
+    counters = {}
+    result = []
+    for K, period, n_digits, algo in items:
+        C = counters.get(period)
+        if C is None:
+            C = counters[period] = _U64(now // (period * _NS_PER_S))
+        result.append(hotp(K, C, n_digits, algo))
+    return result
+
 if __name__ == '__main__':
-    import sys, os, platform, argparse
+    import sys
+    
+    # fast path for a lone secret, skips building the argument parser
+    if len(sys.argv) == 2 and not sys.argv[1].startswith('-'):
+        try:
+            print(totp_from_base32_key(sys.argv[1]))
+        except Exception as e:
+            print('Error:', e)
+            exit(1)
+        exit(0)
+    
+    import os, locale, argparse
 
     parser = argparse.ArgumentParser(
         description="""
@@ -57,11 +237,10 @@ if __name__ == '__main__':
         """
     )
     
-    plat = platform.system()
     user_dir = {
-        'Linux'  : '~/.config/totp/', 
-        'Windows': '~/AppData/Local/totp/'
-    }.get(plat)
+        'linux': '~/.config/totp/', 
+        'win32': '~/AppData/Local/totp/'
+    }.get(sys.platform)
     
     if user_dir:
         default_path = os.path.expanduser(user_dir)
@@ -86,6 +265,13 @@ if __name__ == '__main__':
     add('-f', '--file', type=str, default=default_file)
     args = parser.parse_args()
     
+    def parser_error(message):
+        raise Exception(message)
+    
+    # stored service arguments are parsed later on, their
+    # errors must not print the usage and exit
+    parser.error = parser_error
+    
     def sel(s):
         return {k : args.__dict__[k] for k in s}
     
@@ -103,20 +289,89 @@ if __name__ == '__main__':
     def line_format(service, secret, cmdlineargs):
         return f'{service} {secret} {cmdlineargs}\n'
     
+    cmd_opts = {
+        '-a': 'algo',     '--algo'  : 'algo',
+        '-p': 'period',   '--period': 'period',
+        '-d': 'n_digits', '--digits': 'n_digits',
+    }
+    
+    def cmd2params(a):
+        # fast path for the '--opt value' pairs written by --set,
+        # anything else goes through the argument parser
+        t = a.decode().split()
+        if len(t) % 2 == 0 and all(k in cmd_opts for k in t[::2]):
+            cfg = {'period': 30, 'n_digits': 6, 'algo': 'sha1'}
+            cfg.update((cmd_opts[k], v) for k,v in zip(t[::2], t[1::2]))
+            try:
+                cfg['period'] = int(cfg['period'])
+                cfg['n_digits'] = int(cfg['n_digits'])
+            except ValueError:
+                pass
+            else:
+                if cfg['algo'] in algos:
+                    return cfg
+        a_svc = parser.parse_args(t)
+        return {'period': a_svc.period, 'n_digits': a_svc.digits,
+                'algo': a_svc.algo}
+    
+    class Records:
+        # one list per field, the i-th item of each belongs to the
+        # i-th service; a record is decoded only when its code is needed
+        def __init__(self):
+            self.services = []
+            self.secrets_b32 = []
+            self.cmdargs = []
+        
+        def __len__(self):
+            return len(self.services)
+        
+        def append(self, service, secret, a):
+            self.services.append(service)
+            self.secrets_b32.append(secret)
+            self.cmdargs.append(a)
+        
+        def pop(self, i):
+            for field in vars(self).values():
+                field.pop(i)
+        
+        def params(self, i):
+            # (K, period, n_digits, algo) as taken by totp_many()
+            cfg = cmd2params(self.cmdargs[i])
+            K = _b32decode_fast(self.secrets_b32[i])
+            return K, cfg['period'], cfg['n_digits'], cfg['algo']
+    
+    def decode_name(k):
+        # the file is UTF-8, older versions wrote it in the locale
+        # encoding; undecodable bytes are kept as surrogates (as in
+        # sys.argv) so they are written back as is
+        try:
+            return k.decode()
+        except UnicodeDecodeError:
+            enc = locale.getpreferredencoding(False)
+            return k.decode(enc, errors='surrogateescape')
+    
     def parse_file(file):
-        d = {}
-        for line in open(file):
-            k,s,a = line.strip().split(maxsplit=2)
-            d[k] = [s,a]
-        return d
+        # secrets and arguments are kept as bytes,
+        # only service names are decoded for lookups
+        r = Records()
+        with open(file, 'rb') as f:
+            data = f.read()
+        for line in data.split(b'\n'):
+            line = line.strip()
+            if line:
+                k,s,a = line.split(maxsplit=2)
+                r.append(decode_name(k), s, a)
+        return r
     
     def wirte_records(file, r):
-        f = open(file, 'w')
-        for k,(s,a) in r.items():
-            line = line_format(k, s, a)
-            f.write(line)
-        f.close()
+        with open(file, 'wb') as f:
+            for k,s,a in zip(r.services, r.secrets_b32, r.cmdargs):
+                name = k.encode(errors='surrogateescape')
+                f.write(b'%s %s %s\n' % (name, s, a))
         
+    def printable(b):
+        return b.decode(errors='replace')
+    
     def info(m):
         print("Info:", m, file=sys.stderr)
         
@@ -126,9 +381,9 @@ if __name__ == '__main__':
         print(totp_val)
                 
     try:
-        if args.period not in range(30, 86400+1):
+        if not 30 <= args.period <= 86400:
             raise Exception("--period (-p) not in 30..86400 range")
-        if args.digits not in range(6, 8+1):
+        if not 6 <= args.digits <= 8:
             raise Exception("--digits (-d) not in 6..8 range")
         
         if isfileop():
@@ -148,35 +403,48 @@ if __name__ == '__main__':
             records = parse_file(args.file)
                 
             if args.set:
-                if args.set in records:
+                if args.set in records.services:
                     raise Exception(f"Service '{args.set}' already exists")
                 if not args.secret:
                     raise Exception(f"A secret must be specified")
                 # try to decode a secret:
-                b32decode(args.secret)
+                _b32decode_fast(args.secret)
                 line = line_format(args.set, args.secret, params2cmd())
-                f = open(args.file, 'a')
-                f.write(line)
-                f.close()
+                with open(args.file, 'ab') as f:
+                    f.write(line.encode(errors='surrogateescape'))
                 info(f"Added '{args.set}' to file '{args.file}'")
             elif args.remove:
-                if not args.remove in records:
+                if not args.remove in records.services:
                     raise Exception(f"No such service '{args.remove}'")
-                records.pop(args.remove)
+                records.pop(records.services.index(args.remove))
                 wirte_records(args.file, records)
                 info(f"Service '{args.remove}' has been removed")
             elif args.get:
-                if not args.get in records:
+                if not args.get in records.services:
                     raise Exception(f"No such service '{args.get}'")
-                secret, a = records[args.get]
-                args_svc = parser.parse_args(a.split())
-                print_totp(secret, args_svc)
+                i = records.services.index(args.get)
+                print(totp(*records.params(i)))
             else: # --list
                 if records:
                     print(f"List of available services from '{args.file}':\n")
-                    print(f"{'Service':18} : {'Secret':^18} : Arguments")
-                    for k,(s,a) in sorted(records.items()):
-                        print(f'{k:18} : {s:^18} : {a}')
+                    r = records
+                    valid, items, errors = [], [], {}
+                    for i in range(len(r)):
+                        try:
+                            items.append(r.params(i))
+                            valid.append(i)
+                        except Exception as e:
+                            errors[i] = e
+                    codes = dict(zip(valid, totp_many(items)))
+                    order = sorted(range(len(r)), key=r.services.__getitem__)
+                    print(f"{'Service':18} : {'Secret':^18} : {'TOTP':^8} : Arguments")
+                    for i in order:
+                        c = codes.get(i, '-')
+                        k = printable(r.services[i].encode(errors='surrogateescape'))
+                        s, a = printable(r.secrets_b32[i]), printable(r.cmdargs[i])
+                        if i in errors:
+                            a = f'{a} (Error: {errors[i]})'
+                        print(f'{k:18} : {s:^18} : {c:^8} : {a}')
                 else:
                     print(f"The file '{args.file}' is empty")
                     